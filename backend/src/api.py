@@ -1,55 +1,195 @@
 import os
-from flask import Flask, request, jsonify, abort
+import re
+from functools import wraps
+from flask import Flask, Response, request, abort
 from sqlalchemy import exc
 import json
+import orjson
 from flask_cors import CORS
+from flask_caching import Cache
+from flask_compress import Compress
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import db_drop_and_create_all, setup_db, db, Drink
 from .auth.auth import AuthError, requires_auth
 
 app = Flask(__name__)
 setup_db(app)
-CORS(app)
+# CORS just for the drinks routes, CORS_ORIGINS is a comma separated list.
+cors_origins = [origin.strip()
+                for origin in os.getenv('CORS_ORIGINS', '*').split(',')
+                if origin.strip()]
+CORS(app, resources={r'/drinks*': {'origins': cors_origins}})
+# Compressing the json responses, the drinks lists repeat the same keys.
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+# SimpleCache is per process, with several workers use a shared cache like
+# CACHE_TYPE=RedisCache, see the README.
+cache = Cache(app, config={
+    'CACHE_TYPE': os.getenv('CACHE_TYPE', 'SimpleCache'),
+    'CACHE_REDIS_URL': os.getenv('CACHE_REDIS_URL'),
+    'CACHE_DEFAULT_TIMEOUT': int(os.getenv('CACHE_DEFAULT_TIMEOUT', 60))
+})
 
 '''
 !! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
 '''
 # db_drop_and_create_all()
 
+
+def jsonify(data):
+    """Serialize data with orjson into an application/json response.
+
+    Replaces flask.jsonify, orjson is much faster than the json module and
+    writes bytes directly.
+
+    Args:
+        data (dict): The data to send to the client.
+
+    Returns:
+        Response: The json response, with status 200.
+    """
+    return Response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS),
+                    mimetype='application/json')
+
+
+def get_json_body():
+    """Parse the body of the request with orjson
+
+    Raises:
+        HTTPException: 400, if the body isn't a non empty json object.
+
+    Returns:
+        dict: The parsed body of the request.
+    """
+    try:
+        body = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        abort(400)  # Bad request.
+    # Checking the shape once, so the handlers can use body.get().
+    if not body or not isinstance(body, dict):
+        abort(400)  # Bad request.
+    return body
+
+
+# Suffix added by Flask-Compress to the ETag of compressed responses.
+COMPRESSED_ETAG_SUFFIX = re.compile(r':(?:gzip|br|deflate)"')
+
+
+def conditional(f):
+    """Decorator answering 304 Not Modified when the If-None-Match header
+    of the client matches the ETag of the response.
+
+    Put it above cache.cached, so the ETag is computed just when the
+    response is built and the cached responses are reused.
+
+    Flask-Compress appends the algorithm to the ETag of compressed
+    responses ("<hash>:gzip"), so it's removed from If-None-Match before
+    comparing it with the ETag of the uncompressed response.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        response = app.make_response(f(*args, **kwargs))
+        environ = request.environ
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        # Copying the environ just when there's a suffix to remove.
+        if if_none_match and COMPRESSED_ETAG_SUFFIX.search(if_none_match):
+            environ = dict(environ, HTTP_IF_NONE_MATCH=(
+                COMPRESSED_ETAG_SUFFIX.sub('"', if_none_match)))
+        return response.make_conditional(environ)
+    return wrapper
+
+
+def recipe_json(recipe):
+    """Get a stored recipe as json bytes, ready to copy in a response.
+
+    Recipes written before they were stored with orjson.dumps may not be
+    valid json, so they're checked and encoded again if needed.
+
+    Args:
+        recipe (String): The recipe column of a drink
+
+    Raises:
+        ValueError: If the recipe can't be read with json.loads().
+
+    Returns:
+        bytes: The recipe as json.
+    """
+    raw = recipe.encode()
+    try:
+        orjson.loads(raw)
+        return raw
+    except orjson.JSONDecodeError:
+        return orjson.dumps(json.loads(recipe))
+
+
+def clear_drinks_cache():
+    """Remove the cached drinks lists, must be called after any write."""
+    cache.delete('drinks_short')
+    cache.delete('drinks_long')
+
+
 # ROUTES
 
 
 @app.route('/drinks')
+@conditional
+@cache.cached(key_prefix='drinks_short')
 def get_drinks():
-    drinks = Drink.query.all()
+    # Querying just the columns, plain tuples are cheaper than Drink objects.
+    rows = db.session.query(Drink.id, Drink.title, Drink.recipe).all()
     # If there's not drinks, abort(404).
-    if len(drinks) == 0:
+    if len(rows) == 0:
         abort(404)  # Not found.
     # Using list comprehension to get a list of drinks short model
-    # representation.
-    list_of_drinks = [drink.short() for drink in drinks]
-    return jsonify({'success': True, 'drinks': list_of_drinks}), 200
+    # representation, same as drink.short().
+    list_of_drinks = [
+        {
+            'id': id,
+            'title': title,
+            'recipe': [{'color': r['color'], 'parts': r['parts']}
+                       for r in json.loads(recipe)]
+        }
+        for id, title, recipe in rows]
+    response = jsonify({'success': True, 'drinks': list_of_drinks})
+    # The ETag is a hash of the body, so it changes with the drinks.
+    response.add_etag()
+    return response, 200
 
 
 @app.route('/drinks-detail')
 @requires_auth('get:drinks-detail')
+# The cache goes after requires_auth, so the token is always checked.
+@conditional
+@cache.cached(key_prefix='drinks_long')
 def get_drinks_detail(jwt):
-    drinks = Drink.query.all()
+    # Querying just the columns, plain tuples are cheaper than Drink objects.
+    rows = db.session.query(Drink.id, Drink.title, Drink.recipe).all()
     # If there's not drinks, abort(404).
-    if len(drinks) == 0:
+    if len(rows) == 0:
         abort(404)  # Not found.
-    # Using list comprehension to get a list of drinks long model
-    # representation.
-    list_of_drinks = [drink.long() for drink in drinks]
+    # Building the json of the drinks long model representation directly,
+    # recipes are stored as json so they're copied without being encoded.
+    list_of_drinks = b','.join(
+        b'{"id":%d,"title":%s,"recipe":%s}'
+        % (id, orjson.dumps(title), recipe_json(recipe))
+        for id, title, recipe in rows)
 
-    return jsonify({'success': True, 'drinks': list_of_drinks}), 200
+    response = Response(
+        b'{"success":true,"drinks":[' + list_of_drinks + b']}',
+        mimetype='application/json')
+    # The ETag is a hash of the body, so it changes with the drinks.
+    response.add_etag()
+    return response, 200
 
 
 @app.route('/drinks', methods=["POST"])
 @requires_auth('post:drinks')
 def add_drink(jwt):
-    title = request.json.get('title')
-    recipe = request.json.get('recipe')
+    body = get_json_body()
+    title = body.get('title')
+    recipe = body.get('recipe')
 
     # If the client don't send a title or a recipe data, then abort(400).
     if title is None or recipe is None:
@@ -57,9 +197,10 @@ def add_drink(jwt):
     try:
         drink = Drink()
         drink.title = title
-        # Formatting recipe, changing ' by " to avoid a bug with json.load().
-        drink.recipe = str(recipe).replace("\'", "\"")
+        # Storing recipe as json, so it can be read with json.loads().
+        drink.recipe = orjson.dumps(recipe).decode()
         drink.insert()
+        clear_drinks_cache()
         return jsonify({"success": True, "drinks": drink.long()}), 200
     except exc.DataError:
         abort(422)  # Unprocessable entity.
@@ -68,12 +209,13 @@ def add_drink(jwt):
 @requires_auth('patch:drinks')
 def update_drink(jwt, id):
     try:
-        drink = Drink.query.filter_by(id=id).one_or_none()
+        drink = Drink.query.get(id)
         # If the id recieved is not in the database, abort(404).
         if drink is None:
             abort(404)
-        title = request.json.get('title')
-        recipe = request.json.get('recipe')
+        body = get_json_body()
+        title = body.get('title')
+        recipe = body.get('recipe')
 
         # If the client don't send any data to change the drink, abort(400).
         if title is None and recipe is None:
@@ -83,10 +225,10 @@ def update_drink(jwt, id):
             drink.title = title
         # If recipe is not None we can change recipe with new recipe.
         if recipe is not None:
-            # Formatting recipe, changing ' for " to avoid a bug
-            # with json.load().
-            drink.recipe = str(recipe).replace("\'", "\"")
+            # Storing recipe as json, so it can be read with json.loads().
+            drink.recipe = orjson.dumps(recipe).decode()
         drink.update()
+        clear_drinks_cache()
         return jsonify({"success": True, "drinks": drink.long()}), 200
     except exc.DataError:
         abort(422)  # Unprocessable entity.
@@ -95,11 +237,12 @@ def update_drink(jwt, id):
 @app.route('/drinks/<int:id>', methods=["DELETE"])
 @requires_auth('delete:drinks')
 def delete_drink(jwt, id):
-    drink = Drink.query.filter_by(id=id).one_or_none()
+    drink = Drink.query.get(id)
     # If the id recieved is not in the database, abort(404).
     if drink is None:
         abort(404)
     drink.delete()
+    clear_drinks_cache()
     return jsonify({"success": True, "delete": id})
 
 # Error Handling
@@ -1,15 +1,38 @@
+import hashlib
 import json
 import os
-from flask import request, _request_ctx_stack, abort
+import threading
+import time
+from flask import request, _request_ctx_stack
+from collections import OrderedDict
 from functools import wraps
 from jose import jwt
-from socket import timeout
 from urllib.request import urlopen
 import logging
 
 AUTH0_DOMAIN = 'coffeeshopbo.us.auth0.com'
 ALGORITHMS = os.getenv('ALGORITHMS',['RS256']) 
 API_AUDIENCE = os.getenv('API_AUDIENCE','drink')
+ISSUER = 'https://' + AUTH0_DOMAIN + '/'
+JWKS_URL = ISSUER + '.well-known/jwks.json'
+# Seconds the downloaded JSON Web Key Set is trusted before refetching it.
+JWKS_TTL = 3600
+# Minimum seconds between two forced refetches caused by an unknown kid.
+JWKS_MIN_REFRESH = 30
+
+# Cache of the JSON Web Key Set, rsa keys indexed by their kid.
+_JWKS_CACHE = {'keys_by_kid': {}, 'expires_at': 0, 'fetched_at': 0}
+_JWKS_LOCK = threading.Lock()
+
+# Max number of decoded tokens kept in the cache.
+TOKEN_CACHE_SIZE = 4096
+# Seconds before its expiration that a cached token stops being used.
+TOKEN_EXP_LEEWAY = 5
+
+# Cache of decoded tokens, (payload, exp) indexed by the sha256 of the token,
+# in least recently used order.
+_TOKEN_CACHE = OrderedDict()
+_TOKEN_LOCK = threading.Lock()
 
 # AuthError Exception
 '''
@@ -66,46 +89,170 @@ def get_token_auth_header():
     token = parts[1]
     return token
 
+
+def _refresh_jwks(force=False):
+    """Download the JSON Web Key Set and store its rsa keys in the cache.
+
+    Only one thread downloads at a time, the others reuse its result.
+    If the download fails the keys already cached are kept, and the next
+    attempt is delayed JWKS_MIN_REFRESH seconds.
+
+    Args:
+        force (bool, optional): Refetch even if the cache hasn't expired.
+            Defaults to False.
+    """
+    with _JWKS_LOCK:
+        now = time.time()
+        if not force and now < _JWKS_CACHE['expires_at']:
+            return
+        # Don't let tokens with random kids hammer Auth0.
+        if force and now - _JWKS_CACHE['fetched_at'] < JWKS_MIN_REFRESH:
+            return
+        _JWKS_CACHE['fetched_at'] = now
+        try:
+            jsonurl = urlopen(JWKS_URL, timeout=2)
+            jwks = json.loads(jsonurl.read())
+            # Skipping the keys that aren't rsa keys, like EC keys.
+            keys_by_kid = {
+                key['kid']: {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use'),
+                    'n': key['n'],
+                    'e': key['e']
+                }
+                for key in jwks['keys']
+                if key.get('kty') == 'RSA' and {'kid', 'n', 'e'} <= key.keys()
+            }
+        # OSError covers URLError, timeouts and connection resets, and
+        # ValueError, KeyError, TypeError and AttributeError an unexpected
+        # body.
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            logging.warning('Unable to fetch %s', JWKS_URL, exc_info=True)
+            # Backing off, so an outage doesn't stall every request.
+            _JWKS_CACHE['expires_at'] = now + JWKS_MIN_REFRESH
+            return
+        _JWKS_CACHE['keys_by_kid'] = keys_by_kid
+        _JWKS_CACHE['expires_at'] = now + JWKS_TTL
+
+
+def _get_rsa_key(kid):
+    """Get the rsa key with the given kid from the cached JSON Web Key Set
+
+    The key set is fetched when the cache is expired, and fetched once more
+    if the kid is unknown, in case Auth0 rotated its signing keys.
+
+    Args:
+        kid (String): The key id of the token header
+
+    Raises:
+        AuthError: If the key set has never been fetched.
+
+    Returns:
+        dict: The rsa key, or None if there's no key with that kid.
+    """
+    if time.time() >= _JWKS_CACHE['expires_at']:
+        _refresh_jwks()
+    rsa_key = _JWKS_CACHE['keys_by_kid'].get(kid)
+    if rsa_key is None:
+        _refresh_jwks(force=True)
+        rsa_key = _JWKS_CACHE['keys_by_kid'].get(kid)
+    if not _JWKS_CACHE['keys_by_kid']:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the JSON Web Key Set.'
+        }, 503)
+    return rsa_key
+
+
+def _cache_token(key, payload):
+    """Store a decoded token in the cache until it expires.
+
+    When the cache is full, the expired tokens are dropped first and then
+    the least recently used ones.
+
+    Args:
+        key (bytes): The sha256 digest of the token
+        payload (dict): The decoded token
+    """
+    exp = payload.get('exp')
+    if exp is None:
+        return
+    with _TOKEN_LOCK:
+        _TOKEN_CACHE[key] = (payload, exp)
+        _TOKEN_CACHE.move_to_end(key)
+        if len(_TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+            now = time.time()
+            for expired in [k for k, (_, e) in _TOKEN_CACHE.items()
+                            if now >= e - TOKEN_EXP_LEEWAY]:
+                del _TOKEN_CACHE[expired]
+            while len(_TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+                _TOKEN_CACHE.popitem(last=False)
+
+
 def verify_decode_jwt(token):
+    """ Verify the jwt and decode it, tokens already verified are taken from
+        a cache until they expire, so the signature is checked just once.
+
+    Args:
+        token (String): token got it by get_token_auth_header function
+
+    Raises:
+        AuthError: See _decode_jwt.
+
+    Returns:
+        dict: The payload obtained decoding the token, with its permissions
+            as a frozenset.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    with _TOKEN_LOCK:
+        cached = _TOKEN_CACHE.get(key)
+        if cached is not None:
+            payload, exp = cached
+            if time.time() < exp - TOKEN_EXP_LEEWAY:
+                _TOKEN_CACHE.move_to_end(key)
+                return payload
+            del _TOKEN_CACHE[key]
+
+    payload = _decode_jwt(token)
+    _cache_token(key, payload)
+    return payload
+
+
+def _decode_jwt(token):
     """ Verify the jwt and decode it with JSON Web Key Sets
         'https://coffeeshopbo.us.auth0.com/.well-known/jwks.json'
+        The key set is cached, see _get_rsa_key.
 
     Args:
         token (String): token got it by get_token_auth_header function
 
     Raises:
         AuthError: If the auhotization is malformed
+        AuthError: If the JSON Web Key Set can't be fetched
         AuthError: If the token is expired
         AuthError: if have incorrect claims 
         AuthError: Can't authenticate token
         AuthError: The key provided is erroneous
 
     Returns:
-        list: The payload obtained decoding the token.
+        dict: The payload obtained decoding the token, with its permissions
+            as a frozenset.
     """
-    url = 'https://coffeeshopbo.us.auth0.com/.well-known/jwks.json'
-
-    jsonurl = urlopen(url, timeout=1)
-
-    jwks = json.loads(jsonurl.read())
-
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = _get_rsa_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -113,8 +260,11 @@ def verify_decode_jwt(token):
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer=ISSUER
             )
+            # A frozenset makes the permission checks a hash lookup.
+            if 'permissions' in payload:
+                payload['permissions'] = frozenset(payload['permissions'])
 
             return payload
 
@@ -140,6 +290,19 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+
+# Errors of the permission checks, shared by check_permissions and the
+# wrappers generated by requires_auth.
+PERMISSIONS_MISSING = ({
+    'code': 'invalid_claims',
+    'description': 'Permissions not included in JWT'
+}, 400)
+PERMISSION_NOT_FOUND = ({
+    'code': 'unauthorized',
+    'description': 'Permission not found'
+}, 403)
+
+
 def check_permissions(permission, payload):
     """Check if the api permission is in the payload of the user
 
@@ -154,20 +317,31 @@ def check_permissions(permission, payload):
     Returns:
         bool: True, exist the permission in the payload.
     """
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT'
-        }, 400)
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found'
-        }, 403)
+    permissions = payload.get('permissions')
+    if permissions is None:
+        raise AuthError(*PERMISSIONS_MISSING)
+    if permission not in permissions:
+        raise AuthError(*PERMISSION_NOT_FOUND)
 
     return True
 
 
+# Source of the wrapper generated by requires_auth, the same checks as
+# check_permissions, with {permission} replaced by the repr of the
+# permission so it's compiled as a constant.
+_WRAPPER_TEMPLATE = """
+def wrapper(*args, **kwargs):
+    token = get_token_auth_header()
+    payload = verify_decode_jwt(token)
+    permissions = payload.get('permissions')
+    if permissions is None:
+        raise AuthError(*PERMISSIONS_MISSING)
+    if {permission} not in permissions:
+        raise AuthError(*PERMISSION_NOT_FOUND)
+
+    return f(payload, *args, **kwargs)
+"""
+
 
 def requires_auth(permission=''):
     """This is a decorator used with all the apis that need to check the authentification
@@ -176,21 +350,26 @@ def requires_auth(permission=''):
     Utilize all the functions written above to verify, authentificate jwt, and check 
     its permissions.
 
+    The wrapper is generated from _WRAPPER_TEMPLATE with the permission
+    inlined, doing the same as check_permissions without the function call.
+    The AuthError raised are handled by the errorhandler of the app.
+
     Args:
         permission (str, optional): The permission of the api, for example 'patch:drinks'. Defaults to ''.
     """
+    source = _WRAPPER_TEMPLATE.format(permission=repr(str(permission)))
+    code = compile(source, '<requires_auth {}>'.format(permission), 'exec')
+
     def requires_auth_decorator(f):
-        @wraps(f)
-        
-        def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
-            check_permissions(permission, payload)
-
-            return f(payload, *args, **kwargs)
-
-        return wrapper
+        namespace = {
+            'get_token_auth_header': get_token_auth_header,
+            'verify_decode_jwt': verify_decode_jwt,
+            'AuthError': AuthError,
+            'PERMISSIONS_MISSING': PERMISSIONS_MISSING,
+            'PERMISSION_NOT_FOUND': PERMISSION_NOT_FOUND,
+            'f': f
+        }
+        exec(code, namespace)
+
+        return wraps(f)(namespace['wrapper'])
     return requires_auth_decorator
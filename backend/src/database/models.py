@@ -5,8 +5,20 @@ import json
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = "sqlite:///{}".format(os.path.join(
-                project_dir, database_filename))
+database_path = os.getenv('DATABASE_URL', "sqlite:///{}".format(
+                os.path.join(project_dir, database_filename)))
+
+# Connection pool settings, sized for gunicorn gthread workers.
+engine_options = {
+    'pool_pre_ping': True,
+    'pool_recycle': 1800
+}
+# SQLite file databases don't use a QueuePool, so they don't accept a size.
+if not database_path.startswith('sqlite'):
+    engine_options.update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20))
+    })
 
 db = SQLAlchemy()
 
@@ -19,6 +31,7 @@ setup_db(app)
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     db.app = app
     db.init_app(app)
 
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+
+# The app reads its database from DATABASE_URL when it's imported.
+_, database_file = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database_file
+
+from src.api import app, cache  # noqa: E402
+from src.auth import auth  # noqa: E402
+from src.database.models import db, Drink  # noqa: E402
+
+BARISTA_TOKEN = 'barista-token'
+MANAGER_TOKEN = 'manager-token'
+
+
+def tearDownModule():
+    os.remove(database_file)
+
+
+class DrinksTestCase(unittest.TestCase):
+    """This class represents the coffee shop test case"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            # Enough drinks for the responses to be compressed.
+            for i in range(8):
+                Drink(title='Drink {}'.format(i),
+                      recipe='[{"name": "milk", "color": "white", '
+                             '"parts": 1}]').insert()
+        cache.clear()
+        self.token_keys = []
+        self.barista = self.add_token(BARISTA_TOKEN, ['get:drinks-detail'])
+        self.manager = self.add_token(MANAGER_TOKEN, [
+            'get:drinks-detail', 'post:drinks', 'patch:drinks',
+            'delete:drinks'])
+
+    def tearDown(self):
+        cache.clear()
+        for key in self.token_keys:
+            auth._TOKEN_CACHE.pop(key, None)
+
+    def add_token(self, token, permissions):
+        """Add the token to the cache of decoded tokens, so it isn't
+        verified with Auth0, returning its authorization header."""
+        key = hashlib.sha256(token.encode()).digest()
+        auth._TOKEN_CACHE[key] = (
+            {'permissions': frozenset(permissions)}, time.time() + 3600)
+        self.token_keys.append(key)
+        return {'Authorization': 'Bearer ' + token}
+
+    def add_legacy_drink(self, recipe):
+        """Insert a drink with a recipe as written by older versions."""
+        with app.app_context():
+            Drink(title='Legacy', recipe=recipe).insert()
+
+    def test_get_drinks_not_modified(self):
+        res = self.client.get('/drinks')
+        etag = res.headers['ETag']
+
+        res = self.client.get('/drinks', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_get_drinks_not_modified_gzip(self):
+        headers = {'Accept-Encoding': 'gzip'}
+        res = self.client.get('/drinks', headers=headers)
+        etag = res.headers['ETag']
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(etag.endswith(':gzip"'))
+
+        res = self.client.get('/drinks', headers=dict(
+            headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_get_drinks_detail(self):
+        res = self.client.get('/drinks-detail', headers=self.barista)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['drinks']), 8)
+        self.assertEqual(data['drinks'][0]['recipe'],
+                         [{'name': 'milk', 'color': 'white', 'parts': 1}])
+
+    def test_get_drinks_detail_legacy_recipe(self):
+        # Valid for json.loads(), but not for orjson.
+        self.add_legacy_drink('[{"name": "milk", "color": "white", '
+                              '"parts": NaN}]')
+
+        res = self.client.get('/drinks-detail', headers=self.barista)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['drinks'][-1]['recipe'][0]['parts'])
+
+    def test_get_drinks_detail_invalid_recipe(self):
+        # str(recipe).replace("'", '"') of a recipe with a boolean.
+        self.add_legacy_drink('[{"name": "milk", "color": "white", '
+                              '"parts": 1, "hot": True}]')
+
+        res = self.client.get('/drinks-detail', headers=self.barista)
+
+        self.assertEqual(res.status_code, 500)
+        self.assertIsNone(cache.get('drinks_long'))
+
+    def assertWriteClearsCache(self, write):
+        """Check that after write() both drinks lists are sent again,
+        with the changes, to a client revalidating its ETag."""
+        etags = {}
+        for path in ('/drinks', '/drinks-detail'):
+            res = self.client.get(path, headers=self.manager)
+            etags[path] = res.headers['ETag']
+            self.assertEqual(self.client.get(path, headers=dict(
+                self.manager, **{'If-None-Match': etags[path]})).status_code,
+                304)
+
+        res = write()
+        self.assertEqual(res.status_code, 200)
+
+        with app.app_context():
+            titles = sorted(drink.title for drink in Drink.query.all())
+        for path, etag in etags.items():
+            res = self.client.get(path, headers=dict(
+                self.manager, **{'If-None-Match': etag}))
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res.headers['ETag'], etag)
+            self.assertEqual(
+                sorted(d['title'] for d in json.loads(res.data)['drinks']),
+                titles)
+
+    def test_post_drink_clears_cache(self):
+        self.assertWriteClearsCache(lambda: self.client.post(
+            '/drinks', headers=self.manager, json={
+                'title': 'Water',
+                'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]
+            }))
+
+    def test_patch_drink_clears_cache(self):
+        self.assertWriteClearsCache(lambda: self.client.patch(
+            '/drinks/1', headers=self.manager, json={'title': 'Latte'}))
+
+    def test_delete_drink_clears_cache(self):
+        self.assertWriteClearsCache(lambda: self.client.delete(
+            '/drinks/1', headers=self.manager))
+
+    def assertBadBodies(self, send):
+        """Check that send(body) answers 400 to bodies that aren't a non
+        empty json object."""
+        for body in (b'not json', b'[{"title": "Water"}]', b'{}'):
+            res = send(body)
+            self.assertEqual(res.status_code, 400, body)
+            self.assertEqual(json.loads(res.data)['message'], 'bad request')
+
+    def test_post_drink_bad_body(self):
+        self.assertBadBodies(lambda body: self.client.post(
+            '/drinks', headers=self.manager, data=body,
+            content_type='application/json'))
+
+    def test_patch_drink_bad_body(self):
+        self.assertBadBodies(lambda body: self.client.patch(
+            '/drinks/1', headers=self.manager, data=body,
+            content_type='application/json'))
+
+
+if __name__ == "__main__":
+    unittest.main()
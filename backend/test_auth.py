@@ -0,0 +1,203 @@
+import hashlib
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.error import URLError
+
+from flask import Flask
+
+from src.auth import auth
+from src.auth.auth import AuthError, check_permissions, requires_auth
+
+KEY = {'kid': 'key1', 'kty': 'RSA', 'use': 'sig', 'n': 'n', 'e': 'AQAB'}
+
+
+class JwksCacheTestCase(unittest.TestCase):
+    """This class represents the JSON Web Key Set cache test case"""
+
+    def setUp(self):
+        auth._JWKS_CACHE.update(
+            {'keys_by_kid': {}, 'expires_at': 0, 'fetched_at': 0})
+
+    def test_outage_keeps_stale_keys(self):
+        auth._JWKS_CACHE['keys_by_kid'] = {'key1': KEY}
+        with mock.patch.object(auth, 'urlopen',
+                               side_effect=URLError('down')) as urlopen:
+            threads = [threading.Thread(target=auth._get_rsa_key,
+                                        args=('key1',))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(auth._get_rsa_key('key1'), KEY)
+
+        # Just one attempt, the others wait for the backoff.
+        self.assertEqual(urlopen.call_count, 1)
+        self.assertGreater(auth._JWKS_CACHE['expires_at'], time.time())
+
+    def test_outage_without_keys(self):
+        with mock.patch.object(auth, 'urlopen',
+                               side_effect=URLError('down')) as urlopen:
+            for _ in range(3):
+                with self.assertRaises(AuthError) as context:
+                    auth._get_rsa_key('key1')
+                self.assertEqual(context.exception.status_code, 503)
+
+        self.assertEqual(urlopen.call_count, 1)
+
+    def test_invalid_key_set(self):
+        bodies = [b'<html>Bad gateway</html>', b'{}', b'[]',
+                  b'{"keys": [1]}']
+        for body in bodies:
+            auth._JWKS_CACHE.update({'expires_at': 0, 'fetched_at': 0})
+            response = mock.Mock()
+            response.read.return_value = body
+            with mock.patch.object(auth, 'urlopen', return_value=response):
+                with self.assertRaises(AuthError) as context:
+                    auth._get_rsa_key('key1')
+            self.assertEqual(context.exception.status_code, 503)
+
+    def test_key_set_with_other_keys(self):
+        ec_key = {'kid': 'key2', 'kty': 'EC', 'crv': 'P-256',
+                  'x': 'x', 'y': 'y'}
+        rsa_key_without_use = dict(KEY, kid='key3')
+        del rsa_key_without_use['use']
+        response = mock.Mock()
+        response.read.return_value = json.dumps(
+            {'keys': [KEY, ec_key, rsa_key_without_use]}).encode()
+        with mock.patch.object(auth, 'urlopen', return_value=response):
+            self.assertEqual(auth._get_rsa_key('key1'), KEY)
+            self.assertEqual(auth._get_rsa_key('key3'),
+                             dict(rsa_key_without_use, use=None))
+            self.assertIsNone(auth._get_rsa_key('key2'))
+
+    def test_connection_reset(self):
+        response = mock.Mock()
+        response.read.side_effect = ConnectionResetError()
+        with mock.patch.object(auth, 'urlopen', return_value=response):
+            with self.assertRaises(AuthError) as context:
+                auth._get_rsa_key('key1')
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the decoded tokens cache test case"""
+
+    def setUp(self):
+        auth._TOKEN_CACHE.clear()
+
+    def tearDown(self):
+        auth._TOKEN_CACHE.clear()
+
+    def test_hit_skips_decode(self):
+        payload = {'exp': time.time() + 3600}
+        with mock.patch.object(auth, '_decode_jwt',
+                               return_value=payload) as decode:
+            self.assertIs(auth.verify_decode_jwt('token'), payload)
+            self.assertIs(auth.verify_decode_jwt('token'), payload)
+
+        self.assertEqual(decode.call_count, 1)
+
+    def test_entry_about_to_expire_is_decoded_again(self):
+        key = hashlib.sha256(b'token').digest()
+        expiring = {'exp': time.time() + auth.TOKEN_EXP_LEEWAY - 1}
+        auth._TOKEN_CACHE[key] = (expiring, expiring['exp'])
+        payload = {'exp': time.time() + 3600}
+        with mock.patch.object(auth, '_decode_jwt',
+                               return_value=payload) as decode:
+            self.assertIs(auth.verify_decode_jwt('token'), payload)
+
+        decode.assert_called_once_with('token')
+        self.assertIs(auth._TOKEN_CACHE[key][0], payload)
+
+    def test_payload_without_exp_is_not_cached(self):
+        with mock.patch.object(auth, '_decode_jwt',
+                               return_value={}) as decode:
+            auth.verify_decode_jwt('token')
+            auth.verify_decode_jwt('token')
+
+        self.assertEqual(decode.call_count, 2)
+        self.assertEqual(len(auth._TOKEN_CACHE), 0)
+
+    @mock.patch.object(auth, 'TOKEN_CACHE_SIZE', 3)
+    def test_eviction_drops_expired_first(self):
+        now = time.time()
+        auth._cache_token(b'valid1', {'exp': now + 3600})
+        auth._cache_token(b'valid2', {'exp': now + 3600})
+        auth._cache_token(b'expired', {'exp': now + 1})
+        auth._cache_token(b'valid3', {'exp': now + 3600})
+
+        self.assertEqual(list(auth._TOKEN_CACHE),
+                         [b'valid1', b'valid2', b'valid3'])
+
+    @mock.patch.object(auth, 'TOKEN_CACHE_SIZE', 2)
+    def test_eviction_drops_least_recently_used(self):
+        payload = {'exp': time.time() + 3600}
+        with mock.patch.object(auth, '_decode_jwt',
+                               return_value=payload) as decode:
+            auth.verify_decode_jwt('token1')
+            auth.verify_decode_jwt('token2')
+            # Using token1 again, so token2 is the least recently used.
+            auth.verify_decode_jwt('token1')
+            auth.verify_decode_jwt('token3')
+
+        self.assertEqual(decode.call_count, 3)
+        self.assertEqual(list(auth._TOKEN_CACHE), [
+            hashlib.sha256(token).digest() for token in (b'token1', b'token3')
+        ])
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the permissions checks test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def call_endpoint(self, payload, permission='get:drinks-detail'):
+        """Call an endpoint protected by requires_auth with a token that
+        decodes to payload, returning the AuthError raised, if any."""
+        token = 'token-{}'.format(id(payload))
+        key = hashlib.sha256(token.encode()).digest()
+        auth._TOKEN_CACHE[key] = (payload, time.time() + 3600)
+        endpoint = requires_auth(permission)(lambda jwt: 'ok')
+        headers = {'Authorization': 'Bearer ' + token}
+        with self.app.test_request_context(headers=headers):
+            try:
+                self.assertEqual(endpoint(), 'ok')
+            except AuthError as error:
+                return error
+            finally:
+                del auth._TOKEN_CACHE[key]
+
+    def check(self, payload, permission='get:drinks-detail'):
+        """Return the AuthError raised by check_permissions, if any."""
+        try:
+            self.assertTrue(check_permissions(permission, payload))
+        except AuthError as error:
+            return error
+
+    def assertSameError(self, payload):
+        expected = self.check(payload)
+        actual = self.call_endpoint(payload)
+        self.assertIsNotNone(actual)
+        self.assertEqual(actual.error, expected.error)
+        self.assertEqual(actual.status_code, expected.status_code)
+
+    def test_permission_found(self):
+        payload = {'permissions': frozenset(['get:drinks-detail'])}
+        self.assertIsNone(self.check(payload))
+        self.assertIsNone(self.call_endpoint(payload))
+
+    def test_permissions_missing(self):
+        self.assertSameError({})
+
+    def test_permission_not_found(self):
+        self.assertSameError({'permissions': frozenset(['post:drinks'])})
+
+
+if __name__ == "__main__":
+    unittest.main()